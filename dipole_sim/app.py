@@ -2,17 +2,19 @@ from ipywidgets import (Accordion, Label, Checkbox, Output, VBox, HBox,
                         ToggleButtons, IntSlider, Tab, Layout, Button,
                         Accordion, HTML, Dropdown, GridspecLayout)
 import IPython.display
+import asyncio
 import pathlib
+from collections import OrderedDict
 from matplotlib.backend_bases import MouseButton
 import nibabel as nib
 import numpy as np
-import xarray as xr
+from mne.transforms import apply_trans
 
-from slice import create_slice_fig, plot_slice, get_axis_names_from_slice
+from slice import create_slice_fig, plot_slice, AXIS_IDX, PLANE_AXES
 from evoked_field import (create_topomap_fig, plot_sensors, plot_evoked,
                           reset_topomaps)
 from cursor import enable_crosshair_cursor
-from transforms import gen_ras_to_head_trans
+from transforms import gen_ras_to_head_trans, gen_plane_to_head_trans
 from callbacks import (handle_click_in_slice_browser_mode,
                        handle_click_in_set_dipole_pos_mode,
                        handle_click_in_set_dipole_ori_mode)
@@ -22,6 +24,7 @@ from dipole import (plot_dipole_pos_marker, plot_dipole_ori_marker,
                     update_dipole_ori, update_dipole_pos,
                     draw_dipole_if_necessary)
 from forward import load_fwd_lookup_table
+from mri import T1Volume, get_mmapable_img
 
 
 # This widget will capture the MNE output.
@@ -41,22 +44,29 @@ class App:
         self._info = evoked.info if info is None else info
         self._trans = trans
 
-        img, img_canonical, data_canonical_mm = self._init_mr_image(t1_img)
-        self._t1_img = img
-        self._t1_img_canonical = img_canonical
-        self._t1_img_canonical_data = data_canonical_mm
-        del img, img_canonical, data_canonical_mm
-
         self._subject = subject
         self._data_path = (pathlib.Path('data') if data_path is None
                            else pathlib.Path(data_path))
         self._fwd_path = self._data_path / 'fwd'
         self._subjects_dir = self._data_path / 'subjects'
         self._bem_path = self._data_path / f'{subject}-bem-sol.fif'
+        self._cache_path = self._data_path / 'cache'
 
-        self._fwd_lookup_table = load_fwd_lookup_table(fwd_path=self._fwd_path)
+        img, t1_volume = self._init_mr_image(t1_img)
+        self._t1_img = img
+        self._t1_volume = t1_volume
+        del img, t1_volume
+
+        self._fwd_lookup_table = load_fwd_lookup_table(
+            fwd_path=self._fwd_path, cache_path=self._cache_path)
+        self._leadfield_cache = dict()
 
         self._exact_solution = False
+        self._evoked_update_handle = None
+        self._last_evoked_key = None
+        self._amp_change_delay = 0.15  # seconds
+        self._ori_click_delay = 0.2  # seconds
+        self._ori_click_counter = 0
         self._state = self._init_state()
         self._widget = self._init_widget()
         self._markers = self._init_markers()
@@ -67,6 +77,8 @@ class App:
 
         self._ras_to_head_t = gen_ras_to_head_trans(head_to_mri_t=self._trans,
                                                     t1_img=self._t1_img)
+        self._plane_to_head_t = OrderedDict()
+        self._plane_to_head_t_cache_size = 64
 
         self._preset_coords = {
             'Preset 1': dict(pos=[2.94, -76.54, -0.38],
@@ -79,40 +91,35 @@ class App:
         self._gen_app_layout()
         self._enable_crosshair_cursor()
 
-    @staticmethod
-    def _init_mr_image(img):
-        img_canonical = nib.as_closest_canonical(img)      
-        vox_grid = np.c_[np.arange(img_canonical.dataobj.shape[0]),
-                         np.arange(img_canonical.dataobj.shape[1]),
-                         np.arange(img_canonical.dataobj.shape[2])]
-
-        coords_mm = nib.affines.apply_affine(img_canonical.affine,
-                                             pts=vox_grid)
-        data_canonical_mm = xr.DataArray(data=img_canonical.dataobj,
-                                         dims=('x', 'y', 'z'),
-                                         coords=(coords_mm[:, 0],
-                                                 coords_mm[:, 1],
-                                                 coords_mm[:, 2]))
-
-        return img, img_canonical, data_canonical_mm
+    def _init_mr_image(self, img):
+        # The original image is kept for its header (needed for the
+        # coordinate transforms); the slices are read from a memory-mappable
+        # copy.
+        img_mmap = get_mmapable_img(img, cache_path=self._cache_path,
+                                    subject=self._subject)
+        t1_volume = T1Volume(img_mmap)
+        return img, t1_volume
 
     def _init_state(self):
         state = dict()
-        state['slice_coord'] = dict(x=dict(val=0, min=-60, max=60),
-                                    y=dict(val=0, min=-70, max=70),
-                                    z=dict(val=0, min=-20, max=60))
-        state['crosshair_pos'] = dict(x=0, y=0, z=0)
-        state['dipole_pos'] = dict(x=None, y=None, z=None)
-        state['dipole_ori'] = dict(x=None, y=None, z=None)
+        # All coordinates are stored as (x, y, z) arrays [mm, MRI RAS].
+        state['slice_coord'] = np.zeros(3)
+        state['slice_coord_range'] = np.array([[-60, 60],
+                                               [-70, 70],
+                                               [-20, 60]])
+        state['crosshair_pos'] = np.zeros(3)
+        state['dipole_pos'] = np.full(3, np.nan)
+        state['dipole_pos_set'] = False
+        state['dipole_ori'] = np.full(3, np.nan)
+        state['dipole_ori_set'] = False
         state['dipole_amplitude'] = 50e-9  # Am
         state['label_text'] = dict(
-            x=(f'sagittal (x = {round(state["slice_coord"]["x"]["val"])} mm)'),
-            y=(f'coronal (y = {round(state["slice_coord"]["y"]["val"])} mm)'),
-            z=(f'axial (z = {round(state["slice_coord"]["z"]["val"])} mm)'),
+            x=f'sagittal (x = {int(round(state["slice_coord"][0]))} mm)',
+            y=f'coronal (y = {int(round(state["slice_coord"][1]))} mm)',
+            z=f'axial (z = {int(round(state["slice_coord"][2]))} mm)',
             topomap_mag='Evoked magnetometer field',
             topomap_grad='Evoked gradiometer field',
             topomap_eeg='Evoked EEG field')
-        state['dipole_arrows'] = []
         state['mode'] = 'slice_browser'
         state['updating'] = False
         return state
@@ -127,6 +134,7 @@ class App:
                    y=self._create_slice_fig(),
                    z=self._create_slice_fig())
         widget['fig'] = fig
+        self._fig_to_axis = {id(f): axis for axis, f in fig.items()}
 
         topomap_fig = dict(mag=create_topomap_fig(),
                            grad=create_topomap_fig(),
@@ -180,6 +188,11 @@ class App:
                                            names='value')
         widget['label']['amplitude_slider'] = Label('Dipole amplitude in nAm')
 
+        widget['plot_every_slider'] = IntSlider(value=2, min=1, max=5,
+                                                continuous_update=False)
+        widget['label']['plot_every_slider'] = Label(
+            'Update fields every n-th click when setting the orientation')
+
         widget['quickstart_text'] = HTML(
             value=('<ul>'
                    '<li>Select the desired brain slices in the '
@@ -213,8 +226,13 @@ class App:
 
     def _init_markers(self):
         markers = dict()
+        # Marker artists per slice, and their (x, y) coordinates in the
+        # sagittal, coronal, and axial slices.
         markers['dipole_pos'] = dict(x=None, y=None, z=None)
+        markers['dipole_pos_offsets'] = np.full((3, 2), np.nan)
         markers['dipole_ori'] = dict(x=None, y=None, z=None)
+        markers['dipole_ori_offsets'] = np.full((3, 2), np.nan)
+        markers['dipole_arrow'] = dict(x=None, y=None, z=None)
         return markers
 
     def _create_slice_fig(self):
@@ -246,46 +264,67 @@ class App:
         x, y = event.xdata, event.ydata
 
         # Which slice (axis) was clicked in?
-        for axis, fig in widget['fig'].items():
-            if fig is in_ax.figure:
-                break
+        axis = self._fig_to_axis[id(in_ax.figure)]
 
-        x_idx, y_idx = get_axis_names_from_slice(slice_view=axis,
-                                                 all_axes=widget['fig'].keys())
+        x_idx, y_idx = PLANE_AXES[axis]
         remaining_idx = axis
 
         if state['mode'] == 'slice_browser':
             handle_click_in_slice_browser_mode(widget, markers, state, x, y,
                                                x_idx, y_idx, self._evoked,
-                                               self._t1_img_canonical_data)
+                                               self._t1_volume)
         elif state['mode'] == 'set_dipole_pos':
+            plane_to_head_t = self._get_plane_to_head_t(axis)
             handle_click_in_set_dipole_pos_mode(widget, state, x_idx, y_idx,
                                                 remaining_idx, x, y,
-                                                self._ras_to_head_t,
+                                                plane_to_head_t,
                                                 evoked=self._evoked)
         elif state['mode'] == 'set_dipole_ori':
             # Construct the 3D coordinates of the clicked-on point
+            plane_to_head_t = self._get_plane_to_head_t(axis)
             handle_click_in_set_dipole_ori_mode(widget, state, x_idx, y_idx,
                                                 remaining_idx, x, y,
-                                                self._ras_to_head_t,
+                                                plane_to_head_t,
                                                 evoked=self._evoked)
+            self._ori_click_counter += 1
 
         self._plot_dipole_markers_and_arrow()
         self._enable_crosshair_cursor()
 
-        if (state['dipole_pos']['x'] is not None and
-                state['dipole_ori']['x'] is not None and
-                state['dipole_pos'] != state['dipole_ori']):
-            plot_evoked(widget, state, fwd_path=self._fwd_path,
-                        subject=self._subject, info=self._info,
-                        ras_to_head_t=self._ras_to_head_t,
-                        exact_solution=self._exact_solution,
-                        bem_path=self._bem_path, head_to_mri_t=self._trans,
-                        fwd_lookup_table=self._fwd_lookup_table,
-                        t1_img=self._t1_img)
+        # All click modes reset the topomaps, so they need to be re-plotted.
+        self._last_evoked_key = None
+
+        plot_every = widget['plot_every_slider'].value
+        if (state['mode'] == 'set_dipole_ori' and
+                self._ori_click_counter % plot_every != 0):
+            # Only update the evoked field every n-th click while the user is
+            # exploring orientations; the latest orientation is still plotted
+            # if no further click comes in.
+            self._schedule_evoked_update(delay=self._ori_click_delay)
+        else:
+            self._cancel_evoked_update()
+            self._maybe_plot_evoked()
 
         self._toggle_updating_state()
 
+    def _get_plane_to_head_t(self, axis):
+        """Retrieve the slice -> head transform for the current slice of axis.
+        """
+        slice_pos = self._state['slice_coord'][AXIS_IDX[axis]]
+        key = (axis, slice_pos)
+        cache = self._plane_to_head_t
+
+        if key in cache:
+            cache.move_to_end(key)
+        else:
+            cache[key] = gen_plane_to_head_trans(
+                axis=axis, slice_pos=slice_pos,
+                ras_to_head_t=self._ras_to_head_t)
+            if len(cache) > self._plane_to_head_t_cache_size:
+                cache.popitem(last=False)
+
+        return cache[key]
+
     def _handle_slice_mouse_enter(self, event):
         pass
 
@@ -293,28 +332,61 @@ class App:
         pass
 
     def _handle_amp_change(self, change):
+        self._state['dipole_amplitude'] = change['new'] * 1e-9
+
+        # Coalesce rapid successive changes: only the last value set within
+        # the delay triggers a recomputation of the evoked field.
+        self._schedule_evoked_update(delay=self._amp_change_delay)
+
+    def _schedule_evoked_update(self, delay):
+        self._cancel_evoked_update()
+        # Run on the kernel's event loop, i.e. in the same thread as all other
+        # widget and figure event handlers.
+        loop = asyncio.get_event_loop()
+        self._evoked_update_handle = loop.call_later(
+            delay, self._update_evoked_deferred)
+
+    def _cancel_evoked_update(self):
+        if self._evoked_update_handle is not None:
+            self._evoked_update_handle.cancel()
+            self._evoked_update_handle = None
+
+    @output_widget.capture(clear_output=True)
+    def _update_evoked_deferred(self):
+        self._evoked_update_handle = None
         self._toggle_updating_state()
 
-        state = self._state
         widget = self._widget
-
         widget['amplitude_slider'].disabled = True
+        try:
+            self._maybe_plot_evoked()
+        finally:
+            self._toggle_updating_state()
+            widget['amplitude_slider'].disabled = False
 
-        new_amp = change['new'] * 1e-9
-        self._state['dipole_amplitude'] = new_amp
-
-        if (state['dipole_pos']['x'] is not None and
-                state['dipole_ori']['x'] is not None and
-                state['dipole_pos'] != state['dipole_ori']):
-            plot_evoked(widget, state, fwd_path=self._fwd_path,
-                        subject=self._subject, info=self._info,
-                        ras_to_head_t=self._ras_to_head_t,
-                        exact_solution=self._exact_solution,
-                        bem_path=self._bem_path, head_to_mri_t=self._trans,
-                        fwd_lookup_table=self._fwd_lookup_table,
-                        t1_img=self._t1_img)
-        self._toggle_updating_state()
-        widget['amplitude_slider'].disabled = False
+    def _maybe_plot_evoked(self):
+        """Plot the evoked field if the dipole is fully specified and has
+        changed since it was last plotted.
+        """
+        state = self._state
+        if not (state['dipole_pos_set'] and state['dipole_ori_set'] and
+                not np.array_equal(state['dipole_pos'], state['dipole_ori'])):
+            return
+
+        key = (tuple(state['dipole_pos']), tuple(state['dipole_ori']),
+               state['dipole_amplitude'], self._exact_solution)
+        if key == self._last_evoked_key:
+            return
+
+        plot_evoked(self._widget, state, fwd_path=self._fwd_path,
+                    subject=self._subject, info=self._info,
+                    ras_to_head_t=self._ras_to_head_t,
+                    exact_solution=self._exact_solution,
+                    bem_path=self._bem_path, head_to_mri_t=self._trans,
+                    fwd_lookup_table=self._fwd_lookup_table,
+                    t1_img=self._t1_img,
+                    leadfield_cache=self._leadfield_cache)
+        self._last_evoked_key = key
 
     def _handle_reset_button_click(self, button):
         self._toggle_updating_state()
@@ -323,17 +395,36 @@ class App:
         state = self._state
 
         widget['preset_dropdown'].value = 'Select Preset…'
-        remove_dipole_arrows(widget=widget)
+        remove_dipole_arrows(widget=widget, markers=markers)
         remove_dipole_pos_markers(widget=widget, markers=markers, state=state)
         remove_dipole_ori_markers(widget=widget, markers=markers, state=state)
 
+        # Make sure no references to old artists survive the reset.
+        for kind in ('dipole_pos', 'dipole_ori'):
+            for collection in markers[kind].values():
+                if collection is not None:
+                    collection.remove()
+        self._markers = self._init_markers()
+
         self._state = self._init_state()
+        self._t1_volume.clear_cache()
         self._plot_slice(axis='all')
         reset_topomaps(widget=widget, evoked=self._evoked)
         widget['label']['dipole_pos'].value = 'Not set'
         widget['label']['dipole_ori'].value = 'Not set'
+
+        # Don't trigger an evoked field update when resetting the amplitude;
+        # there is no dipole left to plot.
+        self._cancel_evoked_update()
+        self._ori_click_counter = 0
+        self._last_evoked_key = None
+
+        widget['amplitude_slider'].unobserve(self._handle_amp_change,
+                                             names='value')
         widget['amplitude_slider'].value = (self
                                             ._state['dipole_amplitude'] * 1e9)
+        widget['amplitude_slider'].observe(self._handle_amp_change,
+                                           names='value')
         self._enable_crosshair_cursor()
         self._toggle_updating_state()
 
@@ -352,38 +443,28 @@ class App:
         ori = np.array(preset['ori']).astype(float)
         ori /= np.linalg.norm(ori)
 
-        pos = dict(x=pos[0], y=pos[1], z=pos[2])
-        ori = dict(x=ori[0], y=ori[1], z=ori[2])
         self._state['dipole_pos'] = pos
+        self._state['dipole_pos_set'] = True
         self._state['dipole_ori'] = ori
-        
-        for plane, coord in pos.items():
-            self._state['slice_coord'][plane]['val'] = coord
-
-        state = self._state
-        widget = self._widget
+        self._state['dipole_ori_set'] = True
+        self._state['slice_coord'][:] = pos
 
+        pos_head = apply_trans(trans=self._ras_to_head_t, pts=pos) / 1000
+        ori_head = apply_trans(trans=self._ras_to_head_t, pts=ori) / 1000
         update_dipole_pos(dipole_pos_ras=pos,
-                          ras_to_head_t=self._ras_to_head_t,
+                          dipole_pos_head=pos_head,
                           widget=self._widget, evoked=self._evoked)
         update_dipole_ori(dipole_ori_ras=ori,
-                          ras_to_head_t=self._ras_to_head_t,
+                          dipole_ori_head=ori_head,
                           widget=self._widget, evoked=self._evoked)
         self._plot_slice(axis='all')
         draw_dipole_if_necessary(state=self._state, widget=self._widget,
                                  markers=self._markers)
 
-        if (state['dipole_pos']['x'] is not None and
-                state['dipole_ori']['x'] is not None and
-                state['dipole_pos'] != state['dipole_ori']):
-            plot_evoked(widget, state, fwd_path=self._fwd_path,
-                        subject=self._subject, info=self._info,
-                        ras_to_head_t=self._ras_to_head_t,
-                        exact_solution=self._exact_solution,
-                        bem_path=self._bem_path, head_to_mri_t=self._trans,
-                        fwd_lookup_table=self._fwd_lookup_table,
-                        t1_img=self._t1_img)
-        
+        # The topomaps have been reset above.
+        self._last_evoked_key = None
+        self._maybe_plot_evoked()
+
         self._toggle_updating_state()
 
     def _plot_dipole_markers_and_arrow(self):
@@ -391,16 +472,15 @@ class App:
         widget = self._widget
         markers = self._markers
 
-        if state['dipole_pos']['x'] is not None:
+        if state['dipole_pos_set']:
             plot_dipole_pos_marker(widget, markers, state)
 
-        if state['dipole_ori']['x'] is not None:
+        if state['dipole_ori_set']:
             plot_dipole_ori_marker(widget, markers, state)
 
-        if (state['dipole_pos']['x'] is not None and
-                state['dipole_ori']['x'] is not None and
-                state['dipole_pos'] != state['dipole_ori']):
-            draw_dipole_arrows(widget, state)
+        if (state['dipole_pos_set'] and state['dipole_ori_set'] and
+                not np.array_equal(state['dipole_pos'], state['dipole_ori'])):
+            draw_dipole_arrows(widget, markers, state)
 
     def _set_view_mode(self, new_mode):
         state = self._state
@@ -415,6 +495,8 @@ class App:
     def _handle_view_mode_change(self, change):
         new_mode = change['new']
         self._set_view_mode(new_mode)
+        # Start counting orientation clicks afresh in every session.
+        self._ori_click_counter = 0
 
     def _enable_crosshair_cursor(self):
         enable_crosshair_cursor(self._widget)
@@ -436,9 +518,9 @@ class App:
             axes = (axis,)
 
         for axis in axes:
-            pos = self._state['slice_coord'][axis]['val']
+            pos = self._state['slice_coord'][AXIS_IDX[axis]]
             plot_slice(widget=self._widget, state=self._state, axis=axis,
-                       pos=pos, img_data=self._t1_img_canonical_data)
+                       pos=pos, img_data=self._t1_volume)
 
     def _gen_app_layout(self):
         title = self._widget['title']
@@ -448,6 +530,7 @@ class App:
         fig = self._widget['fig']
         topomap_fig = self._widget['topomap_fig']
         dipole_amp_slider = self._widget['amplitude_slider']
+        plot_every_slider = self._widget['plot_every_slider']
         tab = self._widget['tab']
         output = self._widget['output']
         reset_button = self._widget['reset_button']
@@ -467,6 +550,10 @@ class App:
             [dipole_amp_slider,
              label['amplitude_slider']])
 
+        plot_every_col = VBox(
+            [plot_every_slider,
+             label['plot_every_slider']])
+
         grid = GridspecLayout(3, 3, grid_gap='0', width="95%")
         grid[0, 0] = HBox([label['status'], label['updating']])
         grid[1, 0] = preset
@@ -495,6 +582,7 @@ class App:
                                     topomap_fig['eeg'].canvas],
                                     layout=Layout(align_items='center'))]),
                          dipole_amp_col,
+                         plot_every_col,
                          dipole_props_col],
                         layout=Layout(align_items='center'))
 
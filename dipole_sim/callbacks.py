@@ -1,8 +1,10 @@
+import numpy as np
 from matplotlib.backend_bases import MouseButton
 from mne.transforms import apply_trans
 
 from evoked_field import reset_topomaps
-from slice import plot_slice, draw_crosshairs, get_axis_names_from_slice
+from slice import (plot_slice, draw_crosshairs, get_axis_names_from_slice,
+                   AXIS_IDX)
 from dipole import (draw_dipole_arrows, remove_dipole_arrows,
                     plot_dipole_pos_marker, remove_dipole_pos_markers,
                     plot_dipole_ori_marker, remove_dipole_ori_markers,
@@ -71,24 +73,22 @@ def leave_set_dipole_ori_mode():
 
 def handle_click_in_slice_browser_mode(widget, markers, state, x, y, x_idx,
                                        y_idx, evoked, img_data):
-    state['slice_coord'][x_idx]['val'] = x
-    state['slice_coord'][y_idx]['val'] = y
-    state['crosshair_pos'][x_idx] = x
-    state['crosshair_pos'][y_idx] = y
+    state['slice_coord'][AXIS_IDX[x_idx]] = x
+    state['slice_coord'][AXIS_IDX[y_idx]] = y
+    state['crosshair_pos'][AXIS_IDX[x_idx]] = x
+    state['crosshair_pos'][AXIS_IDX[y_idx]] = y
 
-    remove_dipole_arrows(widget)
+    remove_dipole_arrows(widget, markers)
     remove_dipole_pos_markers(widget, markers, state)
     remove_dipole_ori_markers(widget, markers, state)
 
     widget['label']['dipole_pos'].value = 'Not set'
     widget['label']['dipole_ori'].value = 'Not set'
 
-    state['dipole_pos']['x'] = None
-    state['dipole_pos']['y'] = None
-    state['dipole_pos']['z'] = None
-    state['dipole_ori']['x'] = None
-    state['dipole_ori']['y'] = None
-    state['dipole_ori']['z'] = None
+    state['dipole_pos'][:] = np.nan
+    state['dipole_pos_set'] = False
+    state['dipole_ori'][:] = np.nan
+    state['dipole_ori_set'] = False
 
     # widget['fig'][x_idx].axes[0].clear()
     # widget['fig'][y_idx].axes[0].clear()
@@ -105,34 +105,33 @@ def handle_click_in_slice_browser_mode(widget, markers, state, x, y, x_idx,
 
 
 def handle_click_in_set_dipole_pos_mode(widget, state, x_idx, y_idx,
-                                        remaining_idx, x, y, ras_to_head_t,
+                                        remaining_idx, x, y, plane_to_head_t,
                                         evoked):
-    # for axis in state['dipole_pos'].keys():
-    #     state['dipole_pos'][axis] = state['slice_coord'][axis]['val']
-
     # Construct the 3D coordinates of the clicked-on point
-    dipole_pos_ras = dict()
-    dipole_pos_ras[x_idx] = x
-    dipole_pos_ras[y_idx] = y
-    dipole_pos_ras[remaining_idx] = state['slice_coord'][remaining_idx]['val']
+    dipole_pos_ras = state['slice_coord'].copy()
+    dipole_pos_ras[AXIS_IDX[x_idx]] = x
+    dipole_pos_ras[AXIS_IDX[y_idx]] = y
 
     state['dipole_pos'] = dipole_pos_ras
+    state['dipole_pos_set'] = True
+    dipole_pos_head = (plane_to_head_t @ np.array([x, y, 0., 1.]))[:3]
     update_dipole_pos(dipole_pos_ras=dipole_pos_ras,
-                      ras_to_head_t=ras_to_head_t,
+                      dipole_pos_head=dipole_pos_head,
                       widget=widget, evoked=evoked)
     leave_set_dipole_pos_mode()
 
 
 def handle_click_in_set_dipole_ori_mode(widget, state, x_idx, y_idx,
-                                        remaining_idx, x, y, ras_to_head_t,
+                                        remaining_idx, x, y, plane_to_head_t,
                                         evoked):
-    dipole_ori_ras = dict()
-    dipole_ori_ras[x_idx] = x
-    dipole_ori_ras[y_idx] = y
-    dipole_ori_ras[remaining_idx] = state['slice_coord'][remaining_idx]['val']
+    dipole_ori_ras = state['slice_coord'].copy()
+    dipole_ori_ras[AXIS_IDX[x_idx]] = x
+    dipole_ori_ras[AXIS_IDX[y_idx]] = y
 
     state['dipole_ori'] = dipole_ori_ras
+    state['dipole_ori_set'] = True
+    dipole_ori_head = (plane_to_head_t @ np.array([x, y, 0., 1.]))[:3]
     update_dipole_ori(dipole_ori_ras=dipole_ori_ras,
-                      ras_to_head_t=ras_to_head_t,
+                      dipole_ori_head=dipole_ori_head,
                       widget=widget, evoked=evoked)
     leave_set_dipole_ori_mode()
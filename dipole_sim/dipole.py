@@ -1,163 +1,115 @@
-from mne.transforms import apply_trans
+import numpy as np
 from evoked_field import reset_topomaps
+from slice import AXIS_IDX, PLANE_IDX
 
 
-def remove_dipole_arrows(widget):
-    for axis, fig in widget['fig'].items():
-        ax = widget['fig'][axis].axes[0]
-        artists_to_keep = [artist for artist in ax.artists
-                           if artist.get_label() != 'dipole']
-        ax.artists = artists_to_keep
-        fig.canvas.draw()
+def remove_dipole_arrows(widget, markers):
+    for axis, arrow in markers['dipole_arrow'].items():
+        if arrow is None:
+            continue
+        arrow.remove()
+        markers['dipole_arrow'][axis] = None
+        widget['fig'][axis].canvas.draw_idle()
 
 
-def draw_dipole_arrows(widget, state):
-    remove_dipole_arrows(widget)
+def draw_dipole_arrows(widget, markers, state):
+    remove_dipole_arrows(widget, markers)
     for axis, fig in widget['fig'].items():
         ax = widget['fig'][axis].axes[0]
-
-        if axis == 'x':
-            x_idx = 'y'
-            y_idx = 'z'
-        elif axis == 'y':
-            x_idx = 'x'
-            y_idx = 'z'
-        elif axis == 'z':
-            x_idx = 'x'
-            y_idx = 'y'
+        x_idx, y_idx = PLANE_IDX[AXIS_IDX[axis]]
 
         x = state['dipole_pos'][x_idx]
         y = state['dipole_pos'][y_idx]
-        dx = state['dipole_ori'][x_idx] - state['dipole_pos'][x_idx]
-        dy = state['dipole_ori'][y_idx] - state['dipole_pos'][y_idx]
+        dx = state['dipole_ori'][x_idx] - x
+        dy = state['dipole_ori'][y_idx] - y
 
-        ax.arrow(x=x, y=y, dx=dx, dy=dy, facecolor='white', edgecolor='black',
-                 width=5, head_width=15, length_includes_head=True,
-                 label='dipole')
+        markers['dipole_arrow'][axis] = ax.arrow(
+            x=x, y=y, dx=dx, dy=dy, facecolor='white', edgecolor='black',
+            width=5, head_width=15, length_includes_head=True, label='dipole')
 
-        fig.canvas.draw()
+        fig.canvas.draw_idle()
 
 
-def plot_dipole_pos_marker(widget, markers, state):
-    remove_dipole_pos_markers(widget, markers, state)
-    for axis in state['dipole_pos'].keys():
-        if axis == 'x':
-            x_idx = 'y'
-            y_idx = 'z'
-        elif axis == 'y':
-            x_idx = 'x'
-            y_idx = 'z'
-        elif axis == 'z':
-            x_idx = 'x'
-            y_idx = 'y'
-
-        x = state['dipole_pos'][x_idx]
-        y = state['dipole_pos'][y_idx]
+def _plot_dipole_marker(widget, markers, state, kind, marker):
+    # Update the marker coordinates for all three slices at once.
+    offsets = markers[f'dipole_{kind}_offsets']
+    offsets[:] = state[f'dipole_{kind}'][PLANE_IDX]
 
+    for axis, idx in AXIS_IDX.items():
         ax = widget['fig'][axis].axes[0]
-        markers['dipole_pos'][axis] = ax.scatter(x, y, marker='o', s=50,
-                                                 facecolors='r',
-                                                 edgecolors='r',
-                                                 label='dipole_pos_marker')
-        widget['fig'][axis].canvas.draw()
+        collection = markers[f'dipole_{kind}'][axis]
+        if collection is None:
+            markers[f'dipole_{kind}'][axis] = ax.scatter(
+                offsets[idx, 0], offsets[idx, 1], marker=marker, s=50,
+                facecolors='r', edgecolors='r',
+                label=f'dipole_{kind}_marker')
+        else:
+            collection.set_offsets(offsets[idx:idx + 1])
+            collection.set_visible(True)
+
+        widget['fig'][axis].canvas.draw_idle()
         # FIXME there must be a public function fore this?
         ax.figure.canvas._cursor = 'crosshair'
 
 
-def remove_dipole_pos_markers(widget, markers, state):
-    for axis in state['dipole_pos'].keys():
+def _remove_dipole_marker(widget, markers, kind):
+    markers[f'dipole_{kind}_offsets'][:] = np.nan
+
+    for axis in AXIS_IDX.keys():
         ax = widget['fig'][axis].axes[0]
-        if markers['dipole_pos'][axis] is not None:
-            markers['dipole_pos'][axis].remove()
-            markers['dipole_pos'][axis] = None
-            widget['fig'][axis].canvas.draw()
+        collection = markers[f'dipole_{kind}'][axis]
+        if collection is not None and collection.get_visible():
+            collection.set_visible(False)
+            widget['fig'][axis].canvas.draw_idle()
         # FIXME there must be a public function fore this?
         ax.figure.canvas._cursor = 'crosshair'
 
 
-def plot_dipole_ori_marker(widget, markers, state):
-    remove_dipole_ori_markers(widget, markers, state)
-    for axis in state['dipole_ori'].keys():
-        if axis == 'x':
-            x_idx = 'y'
-            y_idx = 'z'
-        elif axis == 'y':
-            x_idx = 'x'
-            y_idx = 'z'
-        elif axis == 'z':
-            x_idx = 'x'
-            y_idx = 'y'
-
-        x = state['dipole_ori'][x_idx]
-        y = state['dipole_ori'][y_idx]
+def plot_dipole_pos_marker(widget, markers, state):
+    _plot_dipole_marker(widget, markers, state, kind='pos', marker='o')
 
-        ax = widget['fig'][axis].axes[0]
-        markers['dipole_ori'][axis] = ax.scatter(x, y, marker='x', s=50,
-                                                 facecolors='r',
-                                                 edgecolors='r',
-                                                 label='dipole_ori_marker')
-        widget['fig'][axis].canvas.draw()
-        # FIXME there must be a public function fore this?
-        ax.figure.canvas._cursor = 'crosshair'
+
+def remove_dipole_pos_markers(widget, markers, state):
+    _remove_dipole_marker(widget, markers, kind='pos')
+
+
+def plot_dipole_ori_marker(widget, markers, state):
+    _plot_dipole_marker(widget, markers, state, kind='ori', marker='x')
 
 
 def remove_dipole_ori_markers(widget, markers, state):
-    for axis in state['dipole_ori'].keys():
-        ax = widget['fig'][axis].axes[0]
-        if markers['dipole_ori'][axis] is not None:
-            markers['dipole_ori'][axis].remove()
-            markers['dipole_ori'][axis] = None
-            widget['fig'][axis].canvas.draw()
-        # FIXME there must be a public function fore this?
-        ax.figure.canvas._cursor = 'crosshair'
+    _remove_dipole_marker(widget, markers, kind='ori')
 
 
-def update_dipole_pos(dipole_pos_ras, ras_to_head_t, widget, evoked):
-    dipole_pos_head = apply_trans(trans=ras_to_head_t,
-                                  pts=(dipole_pos_ras['x'],
-                                       dipole_pos_ras['y'],
-                                       dipole_pos_ras['z']))
-    dipole_pos_head /= 1000
-    dipole_pos_head = dict(x=dipole_pos_head[0], y=dipole_pos_head[1],
-                           z=dipole_pos_head[2])
-
-    label_text = (f"x={int(round(dipole_pos_ras['x']))}, "
-                  f"y={int(round(dipole_pos_ras['y']))}, "
-                  f"z={int(round(dipole_pos_ras['z']))} [mm, MRI RAS] ⟶ "
-                  f"x={round(dipole_pos_head['x'], 3)}, "
-                  f"y={round(dipole_pos_head['y'], 3)}, "
-                  f"z={round(dipole_pos_head['z'], 3)} [m, MNE Head]")
+def update_dipole_pos(dipole_pos_ras, dipole_pos_head, widget, evoked):
+    label_text = (f"x={int(round(dipole_pos_ras[0]))}, "
+                  f"y={int(round(dipole_pos_ras[1]))}, "
+                  f"z={int(round(dipole_pos_ras[2]))} [mm, MRI RAS] ⟶ "
+                  f"x={round(dipole_pos_head[0], 3)}, "
+                  f"y={round(dipole_pos_head[1], 3)}, "
+                  f"z={round(dipole_pos_head[2], 3)} [m, MNE Head]")
     widget['label']['dipole_pos'].value = label_text
     reset_topomaps(widget=widget, evoked=evoked)
 
 
-def update_dipole_ori(dipole_ori_ras, ras_to_head_t, widget, evoked):
-    dipole_ori_head = apply_trans(trans=ras_to_head_t,
-                                  pts=(dipole_ori_ras['x'],
-                                       dipole_ori_ras['y'],
-                                       dipole_ori_ras['z']))
-    dipole_ori_head /= 1000
-    dipole_ori_head = dict(x=dipole_ori_head[0], y=dipole_ori_head[1],
-                           z=dipole_ori_head[2])
-
-    label_text = (f"x={int(round(dipole_ori_ras['x']))}, "
-                  f"y={int(round(dipole_ori_ras['y']))}, "
-                  f"z={int(round(dipole_ori_ras['z']))} [mm, MRI RAS] ⟶ "
-                  f"x={round(dipole_ori_head['x'], 3)}, "
-                  f"y={round(dipole_ori_head['y'], 3)}, "
-                  f"z={round(dipole_ori_head['z'], 3)} [m, MNE Head]")
+def update_dipole_ori(dipole_ori_ras, dipole_ori_head, widget, evoked):
+    label_text = (f"x={int(round(dipole_ori_ras[0]))}, "
+                  f"y={int(round(dipole_ori_ras[1]))}, "
+                  f"z={int(round(dipole_ori_ras[2]))} [mm, MRI RAS] ⟶ "
+                  f"x={round(dipole_ori_head[0], 3)}, "
+                  f"y={round(dipole_ori_head[1], 3)}, "
+                  f"z={round(dipole_ori_head[2], 3)} [m, MNE Head]")
     widget['label']['dipole_ori'].value = label_text
     reset_topomaps(widget=widget, evoked=evoked)
 
 
 def draw_dipole_if_necessary(state, widget, markers):
-    if state['dipole_pos']['x'] is not None:
+    if state['dipole_pos_set']:
         plot_dipole_pos_marker(widget, markers, state)
 
-    if state['dipole_ori']['x'] is not None:
+    if state['dipole_ori_set']:
         plot_dipole_ori_marker(widget, markers, state)
 
-    if (state['dipole_pos']['x'] is not None and
-            state['dipole_ori']['x'] is not None and
-            state['dipole_pos'] != state['dipole_ori']):
-        draw_dipole_arrows(widget, state)
+    if (state['dipole_pos_set'] and state['dipole_ori_set'] and
+            not np.array_equal(state['dipole_pos'], state['dipole_ori'])):
+        draw_dipole_arrows(widget, markers, state)
@@ -2,11 +2,12 @@ import numpy as np
 import matplotlib.pyplot as plt
 import mne
 from mne.transforms import apply_trans, invert_transform
+from numba import njit
 
 from slice import create_head_grid
 from math_ import find_closest
 from download import download_fwd_from_github, download_bem_from_github
-from forward import gen_forward_solution
+from forward import gen_forward_solution, _fwd_lookup_key
 
 
 def _update_topomap_label(widget, state, ch_type):
@@ -15,36 +16,53 @@ def _update_topomap_label(widget, state, ch_type):
     label.value = label_text
 
 
-def gen_evoked(dipole_ori, dipole_amplitude, info, fwd):
+@njit(cache=True, fastmath=True)
+def _project_leadfield(leadfield_free, dipole_ori, dipole_amplitude):
+    """Collapse a "free" orientation leadfield onto the dipole orientation,
+    and scale it by the dipole amplitude.
+    """
+    n_channels = leadfield_free.shape[0]
+    meeg_data = np.empty((n_channels, 1), dtype=leadfield_free.dtype)
+    for ch_idx in range(n_channels):
+        projection = 0.
+        for dim in range(3):
+            projection += leadfield_free[ch_idx, dim] * dipole_ori[dim]
+        meeg_data[ch_idx, 0] = projection * dipole_amplitude
+    return meeg_data
+
+
+# Compile now, so the first click doesn't have to wait for it.
+_project_leadfield(np.zeros((1, 3), dtype=np.float32),
+                   np.zeros(3, dtype=np.float32), 1.)
+
+
+def gen_evoked(dipole_ori, dipole_amplitude, info, leadfield_free):
     dipole_ori /= np.linalg.norm(dipole_ori)
-    dipole_ori = dipole_ori.reshape(3, 1)
+    dipole_ori = dipole_ori.reshape(3).astype(leadfield_free.dtype)
 
     # Apply the correct weights to each dimension of the leadfield, which is
     # based on a "free" orientation forward model. This essentially collapses
     # the three "free" orientation dimensions into a single "fixed" orientation
-    # dimension.
-    leadfield_free = fwd['sol']['data']
-    leadfield_fixed = leadfield_free @ dipole_ori
-
-    # Now do the actual forward projection (which simply means: scale the
-    # leadfield by the dipole amplitude), and generate an Evoked object.
-    meeg_data = leadfield_fixed * dipole_amplitude
+    # dimension. Then do the actual forward projection (which simply means:
+    # scale the leadfield by the dipole amplitude), and generate an Evoked
+    # object.
+    meeg_data = _project_leadfield(np.ascontiguousarray(leadfield_free),
+                                   dipole_ori, dipole_amplitude)
     evoked = mne.EvokedArray(meeg_data, info)
     return evoked
 
 
 def plot_evoked(widget, state, fwd_path, subject, info, ras_to_head_t,
                 exact_solution, bem_path=None, head_to_mri_t=None,
-                fwd_lookup_table=None, t1_img=None):
+                fwd_lookup_table=None, t1_img=None, leadfield_cache=None):
     if fwd_lookup_table is None:
         raise ValueError('Must prodive fwd_lookup_table')
 
-    dipole_pos = (state['dipole_pos']['x'],
-                  state['dipole_pos']['y'],
-                  state['dipole_pos']['z'])
-    dipole_ori = (state['dipole_ori']['x'],
-                  state['dipole_ori']['y'],
-                  state['dipole_ori']['z'])
+    if leadfield_cache is None:
+        leadfield_cache = dict()
+
+    dipole_pos = state['dipole_pos']
+    dipole_ori = state['dipole_ori']
 
     # dipole_pos = np.array(dipole_pos).reshape(1, 3)
     # dipole_pos = apply_trans(trans=ras_to_head_t, pts=dipole_pos)
@@ -96,6 +114,8 @@ def plot_evoked(widget, state, fwd_path, subject, info, ras_to_head_t,
         bem = mne.read_bem_solution(bem_path)
         fwd = gen_forward_solution(pos=dipole_pos, bem=bem, info=info,
                                    trans=head_to_mri_t)
+        leadfield = fwd['sol']['data'].astype(np.float32)
+        del fwd
     else:
         # Retrieve the dipole pos closest to the one we have a pre-calculated
         # fwd for.
@@ -115,11 +135,13 @@ def plot_evoked(widget, state, fwd_path, subject, info, ras_to_head_t,
                      f'{dipole_pos_for_fwd[0]:.3f}-'
                      f'{dipole_pos_for_fwd[1]:.3f}-'
                      f'{dipole_pos_for_fwd[2]:.3f}-fwd.fif')
-        if (fwd_path / fwd_fname).exists():
+        fwd_key = _fwd_lookup_key(dipole_pos_for_fwd)
+
+        if fwd_key in leadfield_cache:
+            print(f'\nUsing cached forward solution: {fwd_fname}\n')
+        elif (fwd_path / fwd_fname).exists():
             print(f'\nUsing existing forward solution: {fwd_fname}\n')
-        elif not fwd_lookup_table.loc[str(dipole_pos_for_fwd[0]),
-                                      str(dipole_pos_for_fwd[1]),
-                                      str(dipole_pos_for_fwd[2])].iloc[0]:
+        elif fwd_key not in fwd_lookup_table:
             msg = ('No pre-calculated foward solution available for this '
                    'dipole. Please select a dipole origin clearly inside the '
                    'brain.')
@@ -137,10 +159,17 @@ def plot_evoked(widget, state, fwd_path, subject, info, ras_to_head_t,
                        f'the brain.')
                 raise RuntimeError(msg)
 
-        fwd = mne.read_forward_solution(fwd_path / fwd_fname)
-        del fwd_fname, pos_head_grid, dipole_pos_for_fwd
+        if fwd_key not in leadfield_cache:
+            fwd = mne.read_forward_solution(fwd_path / fwd_fname)
+            # Single precision is plenty for visualization.
+            leadfield_cache[fwd_key] = np.ascontiguousarray(
+                fwd['sol']['data'], dtype=np.float32)
+            del fwd
+
+        leadfield = leadfield_cache[fwd_key]
+        del fwd_fname, fwd_key, pos_head_grid, dipole_pos_for_fwd
 
-    evoked = gen_evoked(fwd=fwd,
+    evoked = gen_evoked(leadfield_free=leadfield,
                         dipole_ori=dipole_ori,
                         dipole_amplitude=dipole_amplitude,
                         info=info)
@@ -180,7 +209,7 @@ def plot_evoked(widget, state, fwd_path, subject, info, ras_to_head_t,
             ax_topomap.set_ylim(np.array(mag_topomap_ax.get_ylim()) * 1.05)
 
         cb.set_label(label, fontweight='bold')
-        fig.canvas.draw()
+        fig.canvas.draw_idle()
 
 
 def create_topomap_fig():
@@ -208,7 +237,7 @@ def reset_topomaps(widget, evoked):
         widget['topomap_fig'][ch_type].axes[1].set_axis_off()
 
         plot_sensors(widget=widget, evoked=evoked, ch_type=ch_type)
-        widget['topomap_fig'][ch_type].canvas.draw()
+        widget['topomap_fig'][ch_type].canvas.draw_idle()
 
 
 def plot_sensors(widget, evoked, ch_type):
@@ -218,4 +247,4 @@ def plot_sensors(widget, evoked, ch_type):
                         show=False,
                         axes=ax)
     ax.collections[0].set_sizes([0.05])
-    ax.figure.canvas.draw()
+    ax.figure.canvas.draw_idle()
@@ -1,3 +1,7 @@
+import hashlib
+import os
+import tempfile
+import zipfile
 import numpy as np
 from functools import partial
 import pandas as pd
@@ -55,13 +59,83 @@ def _create_format_coord(axis):
     return partial(format_coord, x_label=x_label, y_label=y_label)
 
 
-def load_fwd_lookup_table(fwd_path):
+def _fwd_lookup_key(pos):
+    """Hashable key for a dipole position [m] on the forward solution grid.
+
+    Positions are converted to integer millimeters to work around floating
+    point precision issues.
+    """
+    return tuple(int(round(p * 1000)) for p in pos)
+
+
+def _get_fwd_lookup_table_cache_fname(lookup_table_path, cache_path):
+    """Name of the cache file, keyed by the lookup table's path, size, and
+    modification time.
+    """
+    stat = lookup_table_path.stat()
+    key = f'{lookup_table_path.resolve()}-{stat.st_size}-{stat.st_mtime}'
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    return cache_path / f'fwd_lookup_table_{digest}.npz'
+
+
+def _read_fwd_lookup_table_cache(cache_fname):
+    """Read a cached lookup table; returns None if the cache is unusable."""
+    try:
+        with np.load(cache_fname) as cache:
+            return cache['valid_positions_mm']
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        return None
+
+
+def _write_fwd_lookup_table_cache(cache_fname, positions_mm):
+    # Write to a temporary file first and move it into place afterwards, so
+    # an interrupted write never leaves a truncated cache file behind.
+    cache_fname.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_fname = tempfile.mkstemp(suffix='.npz', dir=cache_fname.parent)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, valid_positions_mm=positions_mm)
+        # mkstemp() creates the file readable by the owner only.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_fname, 0o666 & ~umask)
+        os.replace(tmp_fname, cache_fname)
+    except BaseException:
+        os.remove(tmp_fname)
+        raise
+
+
+def load_fwd_lookup_table(fwd_path, cache_path=None):
     lookup_table_fname = 'fwd_lookup_table.csv'
     lookup_table_path = fwd_path / lookup_table_fname
 
-    # Convert to str dtype to work around floating point precision issues
-    lookup_table = pd.read_csv(lookup_table_path,
-                               dtype=dict(x=str, y=str, z=str))
-    lookup_table = lookup_table.rename(columns={'success': 'fwd_exists'})
-    lookup_table = lookup_table.set_index(['x', 'y', 'z'])
+    if cache_path is None:
+        cache_fname = None
+    else:
+        cache_fname = _get_fwd_lookup_table_cache_fname(lookup_table_path,
+                                                        cache_path)
+
+    cached = None
+    if cache_fname is not None and cache_fname.exists():
+        cached = _read_fwd_lookup_table_cache(cache_fname)
+
+    if cached is not None:
+        positions_mm = cached
+    else:
+        lookup_table = pd.read_csv(lookup_table_path)
+        # Only keep the grid positions for which a pre-calculated fwd exists.
+        lookup_table = lookup_table[lookup_table['success'].astype(bool)]
+        positions = lookup_table[['x', 'y', 'z']].to_numpy()
+        # Same conversion as in _fwd_lookup_key().
+        positions_mm = np.round(positions * 1000).astype(int)
+
+        if cache_fname is not None:
+            try:
+                _write_fwd_lookup_table_cache(cache_fname,
+                                              positions_mm=positions_mm)
+            except OSError:
+                # E.g. read-only data directory: simply don't cache.
+                pass
+
+    lookup_table = frozenset(map(tuple, positions_mm.tolist()))
     return lookup_table
@@ -0,0 +1,192 @@
+from collections import OrderedDict
+import hashlib
+import os
+import pathlib
+import tempfile
+import numpy as np
+import nibabel as nib
+from nibabel.filebasedimages import ImageFileError
+
+
+# Compressed images larger than this (uncompressed, in bytes) are
+# decompressed to disk once and memory-mapped from there.
+MMAP_MIN_SIZE = 10 * 1024 ** 2
+
+
+class T1Volume:
+    """Lazy, slice-wise access to a T1 image in canonical (RAS) orientation.
+
+    Only the requested plane is read from the underlying nibabel array proxy;
+    the full volume is never loaded into memory. Recently accessed slices
+    are kept in a small LRU cache.
+    """
+    def __init__(self, img, cache_size=64):
+        self._dataobj = img.dataobj
+        self._img_shape = img.shape[:3]
+
+        # Keep slices in the image's on-disk data type (typically uint8 for
+        # T1 images) instead of promoting them to float. Scaled data cannot
+        # be represented in that type, so we leave it alone.
+        self.dtype = img.get_data_dtype()
+        self._scaled = (getattr(img.dataobj, 'slope', 1) != 1 or
+                        getattr(img.dataobj, 'inter', 0) != 0)
+
+        # For each on-disk axis: the canonical axis it maps onto, and whether
+        # it needs to be flipped to be RAS-oriented.
+        self._ornt = nib.io_orientation(img.affine)
+        self.affine = img.affine @ nib.orientations.inv_ornt_aff(
+            self._ornt, self._img_shape)
+        self.shape = tuple(self._img_shape[self._disk_axis(k)]
+                           for k in range(3))
+        self._is_canonical = np.array_equal(self._ornt,
+                                            [[0, 1], [1, 1], [2, 1]])
+
+        # In canonical orientation, the spatial part of the affine is
+        # (approximately) diagonal, so each axis's mm coordinates only depend
+        # on the voxel index along that axis. Oblique images are displayed on
+        # their closest axis-aligned grid, ignoring the small off-diagonal
+        # rotation terms.
+        if np.any(np.isclose(np.diag(self.affine[:3, :3]), 0)):
+            raise ValueError('The T1 image affine is degenerate: at least one '
+                             'voxel axis has zero extent along its closest '
+                             'RAS axis.')
+
+        # Per-axis voxel index -> mm lookup tables, and the inverse mm -> voxel
+        # index mapping as a single multiply-add.
+        self.coords = dict()
+        self._scale = dict()
+        self._inv_scale = dict()
+        self._inv_offset = dict()
+        for k, axis in enumerate(('x', 'y', 'z')):
+            scale = self.affine[k, k]
+            offset = self.affine[k, 3]
+            self.coords[axis] = scale * np.arange(self.shape[k]) + offset
+            self._scale[axis] = scale
+            self._inv_scale[axis] = 1. / scale
+            self._inv_offset[axis] = -offset / scale
+
+        self._cache_size = cache_size
+        self._slice_cache = OrderedDict()
+
+    def _disk_axis(self, canonical_axis):
+        return int(np.flatnonzero(self._ornt[:, 0] == canonical_axis)[0])
+
+    def mm_to_idx(self, axis, pos):
+        idx = int(round(pos * self._inv_scale[axis] + self._inv_offset[axis]))
+        return min(max(idx, 0), len(self.coords[axis]) - 1)
+
+    def get_extent(self, axis):
+        """Extent of a slice perpendicular to `axis`, for use with imshow."""
+        x_axis, y_axis = [a for a in ('x', 'y', 'z') if a != axis]
+        extent = []
+        for a in (x_axis, y_axis):
+            half_vox = self._scale[a] / 2
+            extent.extend([self.coords[a][0] - half_vox,
+                           self.coords[a][-1] + half_vox])
+        return extent
+
+    def get_slice(self, axis, pos):
+        """Retrieve the slice perpendicular to `axis` closest to `pos` (mm).
+
+        The returned 2D array is indexed in canonical axis order, i.e.
+        (y, z) for axis='x', (x, z) for axis='y', and (x, y) for axis='z'.
+        """
+        idx = self.mm_to_idx(axis, pos)
+        key = (axis, idx)
+        if key in self._slice_cache:
+            self._slice_cache.move_to_end(key)
+            return self._slice_cache[key]
+
+        data = self._read_slice(axis, idx)
+        self._slice_cache[key] = data
+        if len(self._slice_cache) > self._cache_size:
+            self._slice_cache.popitem(last=False)
+
+        return data
+
+    def clear_cache(self):
+        self._slice_cache.clear()
+
+    def _read_slice(self, axis, idx):
+        k = ('x', 'y', 'z').index(axis)
+        disk_axis = self._disk_axis(k)
+        if self._ornt[disk_axis, 1] == -1:
+            idx = self.shape[k] - 1 - idx
+
+        slicer = [slice(None)] * 3
+        slicer[disk_axis] = idx
+        data = np.asarray(self._dataobj[tuple(slicer)])
+        if not self._scaled:
+            data = data.astype(self.dtype, copy=False)
+
+        if self._is_canonical:
+            return data
+
+        # Reorient the remaining two on-disk axes to RAS.
+        remaining_disk_axes = [a for a in range(3) if a != disk_axis]
+        for data_axis, a in enumerate(remaining_disk_axes):
+            if self._ornt[a, 1] == -1:
+                data = np.flip(data, axis=data_axis)
+
+        canonical_order = self._ornt[remaining_disk_axes, 0]
+        if canonical_order[0] > canonical_order[1]:
+            data = data.T
+
+        return data
+
+
+def get_mmapable_img(img, cache_path, subject, min_size=MMAP_MIN_SIZE):
+    """Return a version of `img` that can be memory-mapped.
+
+    Large compressed images (e.g. .mgz or .nii.gz) are decompressed once to
+    an uncompressed NIfTI file in `cache_path`, which is then loaded with
+    memory-mapping enabled. All other images are returned unchanged.
+    """
+    fname = img.get_filename()
+    if fname is None or not fname.endswith(('.gz', '.mgz')):
+        return img
+
+    size = np.prod(img.shape) * img.get_data_dtype().itemsize
+    if size < min_size:
+        return img
+
+    fname = pathlib.Path(fname)
+    stat = fname.stat()
+    key = f'{fname.resolve()}-{stat.st_size}-{stat.st_mtime}'
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    cache_fname = cache_path / f'{subject}-T1-{digest}.nii'
+
+    if cache_fname.exists():
+        try:
+            return nib.load(str(cache_fname), mmap=True)
+        except (OSError, ImageFileError):
+            # Corrupt or unreadable cache file: write it again below.
+            pass
+
+    try:
+        _write_uncompressed_img(img, cache_fname)
+        return nib.load(str(cache_fname), mmap=True)
+    except (OSError, ImageFileError):
+        # E.g. read-only data directory: just use the compressed image.
+        return img
+
+
+def _write_uncompressed_img(img, fname):
+    # Write to a temporary file first and move it into place afterwards, so
+    # other kernels never see (and an interrupted write never leaves behind)
+    # a partially written file.
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_fname = tempfile.mkstemp(suffix='.nii', dir=fname.parent)
+    os.close(fd)
+    try:
+        nifti_img = nib.Nifti1Image(np.asanyarray(img.dataobj), img.affine)
+        nifti_img.set_data_dtype(img.get_data_dtype())
+        nib.save(nifti_img, tmp_fname)
+        # mkstemp() creates the file readable by the owner only.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_fname, 0o666 & ~umask)
+        os.replace(tmp_fname, fname)
+    except BaseException:
+        os.remove(tmp_fname)
+        raise
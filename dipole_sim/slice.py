@@ -2,22 +2,22 @@ import numpy as np
 import warnings
 from nilearn.plotting import plot_anat
 import matplotlib.pyplot as plt
-import xarray as xr
 
 from forward import _create_format_coord
 
 
+# Index of each axis in the coordinate arrays stored in the app state.
+AXIS_IDX = dict(x=0, y=1, z=2)
+
+
 def plot_slice(widget, state, axis, pos, img_data):
     if axis == 'x':
-        coord = dict(x=pos)  # Used for xarray slicing below
         x_axis = 'y'
         y_axis = 'z'
     elif axis == 'y':
-        coord = dict(y=pos)
         x_axis = 'x'
         y_axis = 'z'
     elif axis == 'z':
-        coord = dict(z=pos)
         x_axis = 'x'
         y_axis = 'y'
     else:
@@ -25,27 +25,23 @@ def plot_slice(widget, state, axis, pos, img_data):
 
     fig = widget['fig'][axis]
     ax = fig.axes[0]
-    ax.images = []
-
-    kwargs = dict(x=x_axis, y=y_axis,
-                  cmap='gray', vmin=0, vmax=127,
-                  add_colorbar=False, add_labels=False,
-                  ax=ax)
+    for image in list(ax.images):
+        image.remove()
 
-    xr.plot.imshow(img_data.sel(**coord, method='nearest'), **kwargs)
+    slice_data = img_data.get_slice(axis=axis, pos=pos)
+    ax.imshow(slice_data.T, cmap='gray', vmin=0, vmax=127, origin='lower',
+              extent=img_data.get_extent(axis))
     ax.set_axis_off()
     ax.set_aspect('equal')
     ax.format_coord = _create_format_coord(axis)
     # draw_crosshairs(widget=widget, state=state)
-    fig.canvas.draw()
+    fig.canvas.draw_idle()
 
     label_text = state['label_text']
-    label_text['x'] = (f'sagittal '
-                       f'(x = {round(state["slice_coord"]["x"]["val"])} mm)')
-    label_text['y'] = (f'coronal '
-                       f'(y = {round(state["slice_coord"]["y"]["val"])} mm)')
-    label_text['z'] = (f'axial '
-                       f'(z = {round(state["slice_coord"]["z"]["val"])} mm)')
+    slice_coord = state['slice_coord']
+    label_text['x'] = f'sagittal (x = {int(round(slice_coord[0]))} mm)'
+    label_text['y'] = f'coronal (y = {int(round(slice_coord[1]))} mm)'
+    label_text['z'] = f'axial (z = {int(round(slice_coord[2]))} mm)'
 
     for axis in (x_axis, y_axis):
         _update_axis_label(widget=widget, state=state, axis=axis)
@@ -86,12 +82,12 @@ def draw_crosshairs(widget, state):
         x_axis, y_axis = get_axis_names_from_slice(
             slice_view=axis, all_axes=widget['fig'].keys())
 
-        ax.axvline(state['crosshair_pos'][x_axis], **kwargs)
-        ax.axhline(state['crosshair_pos'][y_axis], **kwargs)
+        ax.axvline(state['crosshair_pos'][AXIS_IDX[x_axis]], **kwargs)
+        ax.axhline(state['crosshair_pos'][AXIS_IDX[y_axis]], **kwargs)
 
-    widget['fig']['x'].canvas.draw()
-    widget['fig']['y'].canvas.draw()
-    widget['fig']['z'].canvas.draw()
+    widget['fig']['x'].canvas.draw_idle()
+    widget['fig']['y'].canvas.draw_idle()
+    widget['fig']['z'].canvas.draw_idle()
 
 
 def create_head_grid(info, grid_steps=50):
@@ -148,3 +144,12 @@ def get_axis_names_from_slice(slice_view, all_axes):
         y_idx = 'y'
 
     return x_idx, y_idx
+
+
+# Names of the in-plane (x, y) axes of the sagittal, coronal, and axial
+# slices, and their indices in the coordinate arrays stored in the app state.
+PLANE_AXES = {axis: get_axis_names_from_slice(slice_view=axis,
+                                              all_axes=AXIS_IDX.keys())
+              for axis in AXIS_IDX.keys()}
+PLANE_IDX = np.array([[AXIS_IDX[a] for a in PLANE_AXES[axis]]
+                      for axis in AXIS_IDX.keys()])
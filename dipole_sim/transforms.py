@@ -23,3 +23,24 @@ def gen_ras_to_head_trans(head_to_mri_t, t1_img):
                                        fro='ras', to='head')
 
     return ras_to_head_t
+
+
+def gen_plane_to_head_trans(axis, slice_pos, ras_to_head_t):
+    """Generate the transformation from slice to MNE Head coordinates.
+
+    The returned 4x4 matrix maps points ``(x, y, 0, 1)`` -- where ``x`` and
+    ``y`` are the in-plane coordinates [mm] of the slice perpendicular to
+    ``axis`` and located at ``slice_pos`` [mm, MRI RAS] -- to MNE Head
+    coordinates [m].
+    """
+    k = ('x', 'y', 'z').index(axis)
+    x_idx, y_idx = [i for i in range(3) if i != k]
+
+    plane_to_ras = np.zeros((4, 4))
+    plane_to_ras[x_idx, 0] = 1
+    plane_to_ras[y_idx, 1] = 1
+    plane_to_ras[k, 3] = slice_pos
+    plane_to_ras[3, 3] = 1
+
+    mm_to_m = np.diag([1e-3, 1e-3, 1e-3, 1])
+    return mm_to_m @ ras_to_head_t['trans'] @ plane_to_ras